@@ -1,12 +1,22 @@
 import os
-import json
-import re
-import pdfplumber
+import orjson
+import shutil
+import hashlib
+import functools
+import asyncio
+import tempfile
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from fastapi import FastAPI, UploadFile, File
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
+import diskcache
 import openai  # ✅ Use top-level openai, not OpenAI class
+from openai import AsyncOpenAI
+from pdf_pages import HEADER_RE, extract_pages, page_count
 
 # Load environment variables
 load_dotenv()
@@ -17,8 +27,61 @@ if not OPENAI_API_KEY:
 # ✅ Assign API key directly
 openai.api_key = OPENAI_API_KEY
 
+# ✅ Async client so model calls don't block the event loop; the SDK retries
+# 429/5xx responses with exponential backoff
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=5)
+
 app = FastAPI(title="Billing PDF → Merged Schema Extractor")
 
+# ✅ Bounded pool for blocking file I/O (spooling uploads, cache reads and
+# writes), keeps the event loop free
+_IO_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# ✅ Page extraction is CPU-bound, so it runs in worker processes and large
+# PDFs are split across them by page range. cpu_count() reports host CPUs in
+# containers, so the default stays small; raise PDF_WORKERS on dynos with the
+# memory for more.
+_PDF_WORKERS = int(os.getenv("PDF_WORKERS") or min(os.cpu_count() or 1, 2))
+_MIN_PAGES_PER_WORKER = 8
+
+
+def _new_page_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=_PDF_WORKERS, mp_context=mp.get_context("forkserver")
+    )
+
+
+_PAGE_POOL = _new_page_pool()
+_PAGE_POOL_LOCK = threading.Lock()
+
+# Batch states after which no more results will be written
+_BATCH_ENDED = ("completed", "expired", "cancelled")
+
+# ✅ Prompt budget for the unfiltered fallback, which can be the whole PDF.
+# Filtered table rows are never capped; large tables are chunked instead.
+_MAX_LINES = 400
+_MAX_CHARS = 30_000
+
+# ✅ Large tables are split into chunks that are extracted concurrently; a
+# table needing more than _MAX_CHUNKS chunks is rejected rather than truncated
+_CHUNK_LINES = 80
+_CHUNK_CHARS = 12_000
+_MAX_CHUNKS = 25
+_LLM_SEMAPHORE = asyncio.Semaphore(8)
+
+# ✅ Completion cache for re-uploaded PDFs; bump _PROMPT_VERSION whenever the
+# prompt or schema changes so stale results are not served
+_MODEL = "gpt-4o-mini"
+_PROMPT_VERSION = "v3"
+# Entries hold patient names and member IDs, so they live in a private,
+# app-owned directory and expire after LLM_CACHE_TTL seconds (default 1 day)
+_CACHE_DIR = os.getenv("LLM_CACHE_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".llm_cache"
+)
+_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL") or 24 * 60 * 60)
+os.makedirs(_CACHE_DIR, mode=0o700, exist_ok=True)
+_CACHE = diskcache.Cache(_CACHE_DIR, size_limit=2**30)
+
 
 # ✅ Unified row schema
 class UnifiedRow(BaseModel):
@@ -33,115 +96,432 @@ class UnifiedRow(BaseModel):
     Paid: Optional[str] = None
 
 
+_FIELDS = tuple(UnifiedRow.model_fields)
+
+# ✅ Structured-output schema: the model is constrained to emit exactly these
+# rows, so replies need no client-side validation. Strict mode requires every
+# field to be listed as required, with null standing in for a missing value.
+_ROWS_SCHEMA = {
+    "name": "UnifiedRows",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "rows": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {f: {"type": ["string", "null"]} for f in _FIELDS},
+                    "required": list(_FIELDS),
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["rows"],
+        "additionalProperties": False,
+    },
+}
+
+# ✅ Static prompt prefix, kept byte-identical across requests so OpenAI's
+# automatic prompt caching can reuse it; only the LINES vary per request
+_SYSTEM_PROMPT = (
+    "You are a precise information extraction engine for billing tables. "
+    "You will receive text lines from a PDF (header + rows). "
+    'Return ONLY valid JSON of the form: {"rows": [ ... ]} with NO extra commentary.'
+    """
+
+We have billing tables from different insurers with slightly different headers.
+Unify each row into this MERGED SCHEMA (use strings; use null if missing):
+
+- Name
+- MemberID (from MRN#, MRN, or MBR ID #)
+- T1023AuthId
+- T1023Range
+- T1023BillDate
+- H0044AuthId
+- H0044Range
+- H0044BillDate
+- Paid
+
+IMPORTANT RULES:
+1) Pair RANGE/BILL columns correctly (T1023 vs H0044).
+2) 'MemberID' comes from MRN#/MBR ID #.
+3) Do not invent data. If a cell is blank, use null.
+4) Keep date/range formats as found (e.g., '04/01-07/01').
+5) Output strictly: {"rows": [ UnifiedRow, ... ]}.
+"""
+)
+
+
+def _reset_page_pool(broken: ProcessPoolExecutor) -> None:
+    """Replace the page pool after one of its workers died."""
+    global _PAGE_POOL
+    with _PAGE_POOL_LOCK:
+        # Concurrent requests may all see the same broken pool; only the first
+        # replaces it
+        if _PAGE_POOL is broken:
+            _PAGE_POOL = _new_page_pool()
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+async def _extract_range(
+    pool: ProcessPoolExecutor, path: str, npages: int, keep_all: bool = False
+) -> List[str]:
+    """Run extract_pages over the whole document, page ranges in parallel."""
+    nchunks = max(1, min(_PDF_WORKERS, -(-npages // _MIN_PAGES_PER_WORKER)))
+    size = max(1, -(-npages // nchunks))
+    futures = [
+        pool.submit(extract_pages, path, start, min(start + size, npages), keep_all)
+        for start in range(0, npages, size)
+    ]
+    # Contiguous page ranges, concatenated back in submission order up to the
+    # first range that hit a stop marker
+    all_text_lines: List[str] = []
+    try:
+        for future in futures:
+            lines, stopped = await asyncio.wrap_future(future)
+            all_text_lines.extend(lines)
+            if stopped:
+                break
+    finally:
+        # Later ranges lie past the stop marker (or the request failed); drop
+        # any that have not started
+        for future in futures:
+            future.cancel()
+    return all_text_lines
+
+
+async def _extract_document(
+    pool: ProcessPoolExecutor, path: str, keep_all: bool = False
+) -> List[str]:
+    npages = await asyncio.wrap_future(pool.submit(page_count, path))
+    return await _extract_range(pool, path, npages, keep_all)
+
+
+def _spool(fobj) -> str:
+    """Copy the upload to a temp file the pool workers can open by path."""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        # Stream in 1 MiB blocks rather than buffering the whole upload
+        shutil.copyfileobj(fobj, tmp, length=1 << 20)
+        return tmp.name
+
+
+async def _parse_pdf(fobj) -> Tuple[List[str], bool]:
+    """Extract an upload's table lines, or all of its lines as a fallback.
+
+    Returns the lines and whether they are the unfiltered fallback.
+    """
+    loop = asyncio.get_running_loop()
+    temp_path = await loop.run_in_executor(_IO_EXECUTOR, _spool, fobj)
+    try:
+        for attempt in range(2):
+            pool = _PAGE_POOL
+            try:
+                lines = await _extract_document(pool, temp_path)
+                if lines:
+                    return lines, False
+                # Nothing looked like a table row; re-read the raw text
+                return await _extract_document(pool, temp_path, keep_all=True), True
+            except BrokenProcessPool:
+                # A worker died (OOM kill, or a crash on a hostile file) and
+                # took the pool down with it. Swap in a fresh pool so later
+                # uploads work, and retry once since the crash may have come
+                # from another request sharing the pool.
+                _reset_page_pool(pool)
+                if attempt:
+                    raise
+    finally:
+        os.unlink(temp_path)
+
+
+def _cap_lines(lines: List[str]) -> List[str]:
+    """Cap the unfiltered fallback at the prompt's line/char budget."""
+    out: List[str] = []
+    total = 0
+    for ln in lines:
+        total += len(ln) + 1
+        if len(out) >= _MAX_LINES or total > _MAX_CHARS:
+            break
+        out.append(ln)
+    return out
+
+
 @app.get("/debug")
-async def debug():
+async def debug() -> dict:
     return {"openai_version": openai.__version__}
 
 
 @app.get("/")
-async def root():
+async def root() -> dict:
     return {"status": True, "message": "Billing PDF API is running 🚀"}
 
 
+def _dedupe_headers(lines: List[str]) -> List[str]:
+    """Drop repeated header rows; tables repeat their header on every page."""
+    out: List[str] = []
+    seen_headers = set()
+    for ln in lines:
+        if HEADER_RE.search(ln.upper()):
+            if ln in seen_headers:
+                continue
+            seen_headers.add(ln)
+        out.append(ln)
+    return out
+
+
+def _completion_body(filtered_lines: List[str]) -> dict:
+    """Chat completion parameters for one PDF's filtered lines."""
+    return {
+        "model": _MODEL,
+        "messages": [
+            {"role": "system", "content": _SYSTEM_PROMPT},
+            {"role": "user", "content": "LINES:\n" + "\n".join(filtered_lines)},
+        ],
+        "response_format": {"type": "json_schema", "json_schema": _ROWS_SCHEMA},
+        "temperature": 0,
+    }
+
+
+def _chunk_lines(lines: List[str]) -> List[List[str]]:
+    """Split lines into model-sized chunks, repeating the active header row."""
+    chunks: List[List[str]] = []
+    chunk: List[str] = []
+    size = 0
+    header: Optional[str] = None
+    for ln in lines:
+        is_header = bool(HEADER_RE.search(ln.upper()))
+        if chunk and (len(chunk) >= _CHUNK_LINES or size + len(ln) > _CHUNK_CHARS):
+            chunks.append(chunk)
+            chunk = [header] if header is not None and not is_header else []
+            size = sum(len(c) + 1 for c in chunk)
+        if is_header:
+            header = ln
+        chunk.append(ln)
+        size += len(ln) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+async def _extract_rows(lines: List[str]) -> List[dict]:
+    async with _LLM_SEMAPHORE:
+        completion = await aclient.chat.completions.create(**_completion_body(lines))
+    return orjson.loads(completion.choices[0].message.content)["rows"]
+
+
+async def _extract_chunks(chunks: List[List[str]]) -> List[dict]:
+    """Extract all chunks concurrently, cancelling the rest if one fails."""
+    tasks = [asyncio.create_task(_extract_rows(chunk)) for chunk in chunks]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return [r for chunk_rows in results for r in chunk_rows]
+
+
+def _too_large(nchunks: int) -> str:
+    return f"Table too large: {nchunks} chunks (limit {_MAX_CHUNKS})"
+
+
+def _cache_key(lines: List[str]) -> str:
+    payload = "\n".join(lines) + f"|{_MODEL}|{_PROMPT_VERSION}"
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def _read_pdf_lines(file: UploadFile) -> List[str]:
+    """Parse an upload off the event loop and return its filtered lines."""
+    lines, fallback = await _parse_pdf(file.file)
+    if fallback:
+        # Send the raw text, within budget
+        return _cap_lines(lines)
+    return _dedupe_headers(lines)
+
+
 @app.post("/extract")
-async def extract_merged(file: UploadFile = File(...)):
+async def extract_merged(file: UploadFile = File(...)) -> dict:
     """Upload any billing PDF (OHANA / ALOHA / HMSA)."""
 
     if not file.filename.lower().endswith(".pdf"):
         return {"status": False, "data": [], "error": "Please upload a PDF"}
 
-    # 1) Extract text per page
+    # 1) Extract and filter text lines
     try:
-        all_text_lines: List[str] = []
-        with pdfplumber.open(file.file) as pdf:
-            for page in pdf.pages:
-                t = page.extract_text()
-                if t:
-                    lines = [
-                        re.sub(r"\s+", " ", ln).strip()
-                        for ln in t.split("\n")
-                        if ln.strip()
-                    ]
-                    all_text_lines.extend(lines)
+        filtered_lines = await _read_pdf_lines(file)
     except Exception as e:
         return {"status": False, "data": [], "error": f"PDF read error: {e}"}
 
-    if not all_text_lines:
+    if not filtered_lines:
         return {"status": False, "data": []}
 
-    # 2) Heuristic: filter rows
-    filtered_lines: List[str] = []
-    stop_markers = (
-        "AP'S OVERDUE",
-        "AP'S DUE",
-        "OVERDUE AP",
-        "DUE CM",
-        "SEPTEMBER",
-        "ALL INTAKE",
-        "NEEDS H0044",
-    )
-    for ln in all_text_lines:
-        if any(m in ln.upper() for m in stop_markers):
-            break
-        if ("NAME" in ln.upper()) and (("MRN" in ln.upper()) or ("MBR" in ln.upper())):
-            filtered_lines.append(ln)
-            continue
-        if re.match(r"^\d+\s", ln) or (
-            "," in ln and not ln.upper().startswith("AUGUST")
-        ):
-            filtered_lines.append(ln)
+    chunks = _chunk_lines(filtered_lines)
+    if len(chunks) > _MAX_CHUNKS:
+        return {"status": False, "data": [], "error": _too_large(len(chunks))}
 
-    if not filtered_lines:
-        filtered_lines = all_text_lines
+    # diskcache is synchronous SQLite, so keep it off the event loop
+    loop = asyncio.get_running_loop()
+    key = _cache_key(filtered_lines)
+    cached = await loop.run_in_executor(_IO_EXECUTOR, _CACHE.get, key)
+    if cached is not None:
+        return {"status": True, "data": cached}
+
+    # 2) Ask the model to map lines onto the merged schema, chunks in parallel
+    try:
+        data_list = await _extract_chunks(chunks)
+    except Exception as e:
+        return {"status": False, "data": [], "error": f"AI extraction failed: {e}"}
 
-    # 3) Build AI prompt
-    system_prompt = (
-        "You are a precise information extraction engine for billing tables. "
-        "You will receive text lines from a PDF (header + rows). "
-        'Return ONLY valid JSON of the form: {"rows": [ ... ]} with NO extra commentary.'
+    await loop.run_in_executor(
+        _IO_EXECUTOR, functools.partial(_CACHE.set, key, data_list, expire=_CACHE_TTL)
     )
 
-    user_instructions = f"""
-We have billing tables from different insurers with slightly different headers.
-Unify each row into this MERGED SCHEMA (use strings; use null if missing):
+    return {"status": True, "data": data_list}
 
-- Name
-- MemberID (from MRN#, MRN, or MBR ID #)
-- T1023AuthId
-- T1023Range
-- T1023BillDate
-- H0044AuthId
-- H0044Range
-- H0044BillDate
-- Paid
 
-IMPORTANT RULES:
-1) Pair RANGE/BILL columns correctly (T1023 vs H0044).
-2) 'MemberID' comes from MRN#/MBR ID #.
-3) Do not invent data. If a cell is blank, use null.
-4) Keep date/range formats as found (e.g., '04/01-07/01').
-5) Output strictly: {{"rows": [ UnifiedRow, ... ]}}.
+@app.post("/extract_batch")
+async def extract_batch(files: List[UploadFile] = File(...)) -> dict:
+    """Queue several billing PDFs as one OpenAI Batch job (50% cheaper, async).
 
-LINES:
-{json.dumps(filtered_lines, ensure_ascii=False)}
-"""
+    Poll ``GET /extract_batch/{batch_id}`` for the results.
+    """
+    requests: List[bytes] = []
+    errors: List[dict] = []
+    for i, file in enumerate(files):
+        if not file.filename.lower().endswith(".pdf"):
+            errors.append({"file": file.filename, "error": "Please upload a PDF"})
+            continue
+        try:
+            filtered_lines = await _read_pdf_lines(file)
+        except Exception as e:
+            errors.append({"file": file.filename, "error": f"PDF read error: {e}"})
+            continue
+        if not filtered_lines:
+            errors.append({"file": file.filename, "error": "No text found"})
+            continue
+        chunks = _chunk_lines(filtered_lines)
+        if len(chunks) > _MAX_CHUNKS:
+            errors.append({"file": file.filename, "error": _too_large(len(chunks))})
+            continue
+        # custom_id is "<file index>-<chunk>-<chunk count>-<filename>"; the
+        # index keeps it unique when filenames repeat
+        for c, chunk in enumerate(chunks):
+            requests.append(
+                orjson.dumps(
+                    {
+                        "custom_id": f"{i}-{c}-{len(chunks)}-{file.filename}",
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": _completion_body(chunk),
+                    }
+                )
+            )
+
+    if not requests:
+        return {"status": False, "batch_id": None, "errors": errors}
 
     try:
-        completion = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_instructions},
-            ],
-            response_format={"type": "json_object"},
-            temperature=0,
+        batch_file = await aclient.files.create(
+            file=("batch.jsonl", b"\n".join(requests)),
+            purpose="batch",
+        )
+        batch = await aclient.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
         )
-        content = completion.choices[0].message.content
-        data = json.loads(content)
-        rows = data.get("rows", [])
     except Exception as e:
-        return {"status": False, "data": [], "error": f"AI extraction failed: {e}"}
+        return {
+            "status": False,
+            "batch_id": None,
+            "errors": errors,
+            "error": f"Batch submission failed: {e}",
+        }
+
+    return {"status": True, "batch_id": batch.id, "errors": errors}
+
+
+async def _download_jsonl(file_id: str) -> List[dict]:
+    content = await aclient.files.content(file_id)
+    return [orjson.loads(line) for line in content.content.splitlines() if line.strip()]
 
-    normalized: List[UnifiedRow] = [UnifiedRow(**r) for r in rows]
 
-    return {"status": True, "data": [row.dict() for row in normalized]}
+def _batch_item_error(item: dict) -> Optional[str]:
+    """Error message for a failed batch request line, or None if it succeeded."""
+    response = item.get("response") or {}
+    error = item.get("error") or (response.get("body") or {}).get("error")
+    if error:
+        return error.get("message") or str(error)
+    if response.get("status_code") != 200:
+        return f"HTTP {response.get('status_code')}"
+    return None
+
+
+@app.get("/extract_batch/{batch_id}")
+async def extract_batch_results(batch_id: str) -> dict:
+    """Batch job status, plus per-file rows or errors once the job has ended."""
+    try:
+        batch = await aclient.batches.retrieve(batch_id)
+    except Exception as e:
+        return {"status": False, "data": [], "error": f"Batch lookup failed: {e}"}
+
+    if batch.status == "failed":
+        # The input was rejected as a whole; no request ran
+        errors = (batch.errors.data if batch.errors else None) or []
+        detail = "; ".join(e.message for e in errors if e.message)
+        return {
+            "status": False,
+            "batch_status": batch.status,
+            "data": [],
+            "error": "Batch failed" + (f": {detail}" if detail else ""),
+        }
+
+    if batch.status not in _BATCH_ENDED:
+        return {"status": True, "batch_status": batch.status, "data": []}
+
+    # Successful requests land in the output file and failed ones in the error
+    # file; either may be absent. Expired and cancelled batches still write the
+    # requests that finished, and those have already been paid for.
+    try:
+        items: List[dict] = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                items.extend(await _download_jsonl(file_id))
+    except Exception as e:
+        return {"status": False, "data": [], "error": f"Batch download failed: {e}"}
+
+    # Output lines are unordered; regroup chunks by file index
+    by_file: dict = {}
+    for item in items:
+        idx, c, n, filename = item["custom_id"].split("-", 3)
+        entry = by_file.setdefault(
+            int(idx), {"file": filename, "n": int(n), "chunks": {}, "error": None}
+        )
+        error = _batch_item_error(item)
+        if error is None:
+            try:
+                content = item["response"]["body"]["choices"][0]["message"]["content"]
+                entry["chunks"][int(c)] = orjson.loads(content)["rows"]
+            except Exception as e:
+                error = str(e)
+        if error is not None and entry["error"] is None:
+            entry["error"] = error
+
+    results = []
+    for idx in sorted(by_file):
+        entry = by_file[idx]
+        error = entry["error"]
+        if error is None and len(entry["chunks"]) != entry["n"]:
+            error = "missing chunk results"
+        if error is not None:
+            error = f"AI extraction failed: {error}"
+            results.append({"file": entry["file"], "data": [], "error": error})
+            continue
+        rows = [r for c in range(entry["n"]) for r in entry["chunks"][c]]
+        results.append({"file": entry["file"], "data": rows})
+
+    return {
+        "status": any("error" not in r for r in results),
+        "batch_status": batch.status,
+        "data": results,
+    }
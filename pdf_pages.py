@@ -0,0 +1,81 @@
+"""Page-level PDF text extraction, run inside the process pool.
+
+Kept separate from ``main`` so pool workers only import ``re`` and
+``pypdfium2`` to unpickle their task, not the whole FastAPI app. PDFium is
+not thread-safe, so these functions must only ever run in the pool's
+single-threaded worker processes, never on the app's threads.
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+import pypdfium2 as pdfium
+
+# ✅ Precompiled patterns for the per-line hot loop
+WS_RE = re.compile(r"\s+")
+LEADING_NUM_RE = re.compile(r"^\d+\s")
+
+# Sections that follow the billing table; filtering stops at the first hit
+STOP_MARKERS = (
+    "AP'S OVERDUE",
+    "AP'S DUE",
+    "OVERDUE AP",
+    "DUE CM",
+    "SEPTEMBER",
+    "ALL INTAKE",
+    "NEEDS H0044",
+)
+STOP_RE = re.compile("|".join(re.escape(m) for m in STOP_MARKERS))
+# Header row: contains NAME plus MRN or MBR, in any order
+HEADER_RE = re.compile(r"^(?=.*NAME)(?=.*(?:MRN|MBR))", re.S)
+
+
+def page_count(path: str) -> int:
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def extract_pages(
+    path: str, start: int = 0, end: Optional[int] = None, keep_all: bool = False
+) -> Tuple[List[str], bool]:
+    """Extract cleaned table lines from pages [start, end) in a single pass.
+
+    Only header and data rows are kept, and extraction stops at the first stop
+    marker; ``keep_all`` keeps every non-empty line instead. Returns the lines
+    and whether a stop marker was hit.
+    """
+    all_text_lines: List[str] = []
+    # Pages are never rendered and forms are never initialised, so path/fill
+    # operators and images are parsed at most once and never painted or decoded
+    pdf = pdfium.PdfDocument(path)
+    try:
+        for i in range(start, len(pdf) if end is None else end):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            t = textpage.get_text_range()
+            # Free native page objects before moving on
+            textpage.close()
+            page.close()
+            for ln in t.splitlines():
+                s = ln.strip()
+                if not s:
+                    continue
+                s = WS_RE.sub(" ", s)
+                if keep_all:
+                    all_text_lines.append(s)
+                    continue
+                u = s.upper()
+                if STOP_RE.search(u):
+                    return all_text_lines, True
+                if (
+                    HEADER_RE.search(u)
+                    or LEADING_NUM_RE.match(s)
+                    or ("," in s and not u.startswith("AUGUST"))
+                ):
+                    all_text_lines.append(s)
+    finally:
+        pdf.close()
+    return all_text_lines, False
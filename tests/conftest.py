@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# main.py reads its configuration at import time
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LLM_CACHE_DIR", tempfile.mkdtemp(prefix="llm_cache_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,502 @@
+import asyncio
+import json
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class SerialPool:
+    """Stand-in for the page process pool that runs tasks inline, in order."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def write_pdf(path, pages):
+    """Write a minimal Helvetica PDF with one text line per list entry."""
+    n = len(pages)
+    font = 3 + 2 * n
+    objs = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        (
+            "<< /Type /Pages /Kids [%s] /Count %d >>"
+            % (" ".join(f"{3 + 2 * i} 0 R" for i in range(n)), n)
+        ).encode(),
+    ]
+    for i, lines in enumerate(pages):
+        objs.append(
+            (
+                "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                f"/Contents {4 + 2 * i} 0 R "
+                f"/Resources << /Font << /F1 {font} 0 R >> >> >>"
+            ).encode()
+        )
+        body = "BT /F1 10 Tf 14 TL 40 750 Td "
+        body += " ".join(f"({ln}) Tj T*" for ln in lines) + " ET"
+        objs.append(f"<< /Length {len(body)} >>\nstream\n{body}\nendstream".encode())
+    objs.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for k, obj in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += f"{k} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{o:010d} 00000 n \n".encode() for o in offsets)
+    out += (
+        f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode()
+    path.write_bytes(out)
+    return str(path)
+
+
+def page(n):
+    return ["Billing report", f"{n} Doe, Jane 123"]
+
+
+def parse(path):
+    with open(path, "rb") as f:
+        return asyncio.run(main._parse_pdf(f))
+
+
+def crash(*args):
+    os._exit(1)
+
+
+@pytest.fixture
+def serial_pool(monkeypatch):
+    monkeypatch.setattr(main, "_PAGE_POOL", SerialPool())
+    # Force one page per range so page ranges are exercised on small PDFs
+    monkeypatch.setattr(main, "_PDF_WORKERS", 3)
+    monkeypatch.setattr(main, "_MIN_PAGES_PER_WORKER", 1)
+
+
+@pytest.fixture
+def broken_pool(monkeypatch):
+    pool = ProcessPoolExecutor(max_workers=1)
+    with pytest.raises(BrokenProcessPool):
+        pool.submit(os._exit, 1).result()
+    monkeypatch.setattr(main, "_PAGE_POOL", pool)
+    yield pool
+    if main._PAGE_POOL is not pool:
+        main._PAGE_POOL.shutdown()
+
+
+def test_extract_range_keeps_page_order(tmp_path, serial_pool):
+    path = write_pdf(tmp_path / "a.pdf", [page(n) for n in range(5)])
+
+    lines = asyncio.run(main._extract_range(main._PAGE_POOL, path, 5))
+
+    assert lines == [f"{n} Doe, Jane 123" for n in range(5)]
+
+
+def test_extract_range_stops_at_marker_in_middle_range(tmp_path, serial_pool):
+    pages = [page(n) for n in range(6)]
+    pages[2] = ["2 Doe, Jane 123", "DUE CM", "2 Roe, Rick 456"]
+    path = write_pdf(tmp_path / "a.pdf", pages)
+
+    # Three ranges of two pages; the marker sits in the second
+    lines = asyncio.run(main._extract_range(main._PAGE_POOL, path, 6))
+
+    assert lines == ["0 Doe, Jane 123", "1 Doe, Jane 123", "2 Doe, Jane 123"]
+
+
+def test_parse_pdf_keeps_only_table_rows(tmp_path, serial_pool):
+    path = write_pdf(
+        tmp_path / "a.pdf",
+        [["Billing report", "NAME MRN#", "1   Doe, Jane   123", "AUGUST 1, 2024"]],
+    )
+
+    assert parse(path) == (["NAME MRN#", "1 Doe, Jane 123"], False)
+
+
+def test_parse_pdf_falls_back_to_all_lines(tmp_path, serial_pool):
+    path = write_pdf(tmp_path / "a.pdf", [["Billing report"], ["DUE CM", "Notes"]])
+
+    # Nothing matched, so every line comes back, stop markers included
+    assert parse(path) == (["Billing report", "DUE CM", "Notes"], True)
+
+
+def test_parse_pdf_recovers_from_broken_pool(tmp_path, broken_pool):
+    path = write_pdf(tmp_path / "a.pdf", [page(1)])
+
+    assert parse(path) == (["1 Doe, Jane 123"], False)
+    assert main._PAGE_POOL is not broken_pool
+
+
+def test_worker_crash_fails_only_current_request(tmp_path, broken_pool, monkeypatch):
+    path = write_pdf(tmp_path / "a.pdf", [page(1)])
+
+    with monkeypatch.context() as m:
+        m.setattr(main, "page_count", crash)
+        with pytest.raises(BrokenProcessPool):
+            parse(path)
+
+    assert parse(path) == (["1 Doe, Jane 123"], False)
+
+
+def test_cap_lines_applies_line_budget(monkeypatch):
+    monkeypatch.setattr(main, "_MAX_LINES", 3)
+
+    assert main._cap_lines([f"{n} row" for n in range(10)]) == [
+        "0 row",
+        "1 row",
+        "2 row",
+    ]
+
+
+def test_cap_lines_applies_char_budget(monkeypatch):
+    monkeypatch.setattr(main, "_MAX_CHARS", 12)
+
+    # Each line costs its length plus a newline
+    assert main._cap_lines(["aaaaa", "bbbbb", "ccccc"]) == ["aaaaa", "bbbbb"]
+
+
+def test_dedupe_headers_keeps_identical_data_rows():
+    lines = ["NAME MRN#", "1 Doe, Jane 123", "NAME MRN#", "1 Doe, Jane 123"]
+
+    # Identical data rows are real rows and are kept
+    assert main._dedupe_headers(lines) == [
+        "NAME MRN#",
+        "1 Doe, Jane 123",
+        "1 Doe, Jane 123",
+    ]
+
+
+class FakeOpenAI:
+    """Records batch submissions and serves canned batches and JSONL files."""
+
+    def __init__(self):
+        self.batch = None
+        self.contents = {}
+        self.uploaded = None
+        self.files = SimpleNamespace(create=self._create_file, content=self._content)
+        self.batches = SimpleNamespace(
+            create=self._create_batch, retrieve=self._retrieve
+        )
+
+    async def _create_file(self, file, purpose):
+        self.uploaded = file[1]
+        return SimpleNamespace(id="file_in")
+
+    async def _create_batch(self, **kwargs):
+        return SimpleNamespace(id="batch_1")
+
+    async def _retrieve(self, batch_id):
+        return self.batch
+
+    async def _content(self, file_id):
+        lines = (json.dumps(item) for item in self.contents[file_id])
+        return SimpleNamespace(content="\n".join(lines).encode("utf-8"))
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    fake = FakeOpenAI()
+    monkeypatch.setattr(main, "aclient", fake)
+    return fake
+
+
+def ok_line(custom_id, rows):
+    content = json.dumps({"rows": rows})
+    body = {"choices": [{"message": {"content": content}}]}
+    return {"custom_id": custom_id, "response": {"status_code": 200, "body": body}}
+
+
+def http_error_line(custom_id, status_code, message):
+    body = {"error": {"message": message}}
+    return {
+        "custom_id": custom_id,
+        "response": {"status_code": status_code, "body": body},
+        "error": None,
+    }
+
+
+def expired_line(custom_id):
+    error = {"code": "batch_expired", "message": "request expired"}
+    return {"custom_id": custom_id, "response": None, "error": error}
+
+
+def batch(status, output=None, error=None, errors=None):
+    return SimpleNamespace(
+        status=status, output_file_id=output, error_file_id=error, errors=errors
+    )
+
+
+def batch_results(batch_id="batch_1"):
+    return asyncio.run(main.extract_batch_results(batch_id))
+
+
+def test_extract_batch_builds_unique_custom_ids(fake_openai, monkeypatch):
+    async def read_lines(file):
+        return ["1 Doe, Jane 123"]
+
+    monkeypatch.setattr(main, "_read_pdf_lines", read_lines)
+    files = [
+        SimpleNamespace(filename="a-b.pdf"),
+        SimpleNamespace(filename="notes.txt"),
+        SimpleNamespace(filename="a-b.pdf"),
+    ]
+
+    result = asyncio.run(main.extract_batch(files))
+
+    assert result["status"] is True
+    assert result["errors"] == [{"file": "notes.txt", "error": "Please upload a PDF"}]
+    requests = [json.loads(ln) for ln in fake_openai.uploaded.splitlines()]
+    assert [r["custom_id"] for r in requests] == ["0-0-1-a-b.pdf", "2-0-1-a-b.pdf"]
+
+
+def test_batch_results_restore_upload_order_for_hyphenated_names(fake_openai):
+    fake_openai.batch = batch("completed", output="out")
+    fake_openai.contents["out"] = [
+        ok_line("10-0-1-z-last.pdf", [{"Name": "Z"}]),
+        ok_line("2-0-1-my-file.pdf", [{"Name": "A"}]),
+    ]
+
+    result = batch_results()
+
+    assert result["status"] is True
+    assert [(r["file"], r["data"][0]["Name"]) for r in result["data"]] == [
+        ("my-file.pdf", "A"),
+        ("z-last.pdf", "Z"),
+    ]
+
+
+def test_batch_results_report_failed_requests(fake_openai):
+    fake_openai.batch = batch("completed", output="out", error="err")
+    fake_openai.contents["out"] = [
+        ok_line("0-0-1-a.pdf", [{"Name": "A"}]),
+        http_error_line("1-0-1-b.pdf", 400, "too long"),
+    ]
+    fake_openai.contents["err"] = [expired_line("2-0-1-c.pdf")]
+
+    result = batch_results()
+
+    assert result["status"] is True
+    assert result["data"][1:] == [
+        {"file": "b.pdf", "data": [], "error": "AI extraction failed: too long"},
+        {"file": "c.pdf", "data": [], "error": "AI extraction failed: request expired"},
+    ]
+
+
+def test_batch_results_status_false_when_every_request_failed(fake_openai):
+    fake_openai.batch = batch("completed", error="err")
+    fake_openai.contents["err"] = [http_error_line("0-0-1-a.pdf", 500, "overloaded")]
+
+    result = batch_results()
+
+    assert result["status"] is False
+    assert result["data"] == [
+        {"file": "a.pdf", "data": [], "error": "AI extraction failed: overloaded"}
+    ]
+
+
+@pytest.mark.parametrize("status", ["expired", "cancelled"])
+def test_ended_batch_returns_finished_rows(fake_openai, status):
+    fake_openai.batch = batch(status, output="out", error="err")
+    fake_openai.contents["out"] = [ok_line("0-0-1-a.pdf", [{"Name": "A"}])]
+    fake_openai.contents["err"] = [expired_line("1-0-1-b.pdf")]
+
+    result = batch_results()
+
+    assert result["status"] is True
+    assert result["batch_status"] == status
+    assert result["data"][0]["data"][0]["Name"] == "A"
+    assert result["data"][1]["error"] == "AI extraction failed: request expired"
+
+
+def test_failed_batch_returns_no_results(fake_openai):
+    errors = SimpleNamespace(data=[SimpleNamespace(message="invalid JSONL")])
+    fake_openai.batch = batch("failed", errors=errors)
+
+    result = batch_results()
+
+    assert result == {
+        "status": False,
+        "batch_status": "failed",
+        "data": [],
+        "error": "Batch failed: invalid JSONL",
+    }
+
+
+def test_running_batch_reports_status_only(fake_openai):
+    fake_openai.batch = batch("in_progress")
+
+    assert batch_results() == {
+        "status": True,
+        "batch_status": "in_progress",
+        "data": [],
+    }
+
+
+def test_batch_item_error():
+    assert main._batch_item_error(ok_line("0-a.pdf", [])) is None
+    assert main._batch_item_error(http_error_line("0-a.pdf", 429, "slow")) == "slow"
+    assert main._batch_item_error(expired_line("0-a.pdf")) == "request expired"
+    no_body = {"custom_id": "0-a.pdf", "response": {"status_code": 502}}
+    assert main._batch_item_error(no_body) == "HTTP 502"
+
+
+def test_batch_results_reassemble_chunks_out_of_order(fake_openai):
+    fake_openai.batch = batch("expired", output="out", error="err")
+    fake_openai.contents["out"] = [
+        ok_line("0-1-2-a.pdf", [{"Name": "second"}]),
+        ok_line("1-0-2-b.pdf", [{"Name": "B"}]),
+        ok_line("0-0-2-a.pdf", [{"Name": "first"}]),
+    ]
+    # b.pdf's second chunk never ran before the batch expired
+    fake_openai.contents["err"] = []
+
+    result = batch_results()
+
+    assert [r["Name"] for r in result["data"][0]["data"]] == ["first", "second"]
+    assert result["data"][1] == {
+        "file": "b.pdf",
+        "data": [],
+        "error": "AI extraction failed: missing chunk results",
+    }
+
+
+def test_chunk_lines_carries_header_into_next_chunk(monkeypatch):
+    monkeypatch.setattr(main, "_CHUNK_LINES", 3)
+    lines = ["NAME MRN", "1 a", "2 b", "3 c", "4 d"]
+
+    assert main._chunk_lines(lines) == [
+        ["NAME MRN", "1 a", "2 b"],
+        ["NAME MRN", "3 c", "4 d"],
+    ]
+
+
+def test_chunk_lines_boundary_right_after_header(monkeypatch):
+    monkeypatch.setattr(main, "_CHUNK_LINES", 3)
+    # The first chunk ends on a new header: the next chunk repeats that
+    # header, not the one before it
+    lines = ["NAME MRN", "1 a", "NAME MBR", "2 b", "3 c"]
+
+    assert main._chunk_lines(lines) == [
+        ["NAME MRN", "1 a", "NAME MBR"],
+        ["NAME MBR", "2 b", "3 c"],
+    ]
+
+
+def test_chunk_lines_new_header_at_boundary_is_not_doubled(monkeypatch):
+    monkeypatch.setattr(main, "_CHUNK_LINES", 3)
+    lines = ["NAME MRN", "1 a", "2 b", "NAME MBR", "3 c"]
+
+    assert main._chunk_lines(lines) == [
+        ["NAME MRN", "1 a", "2 b"],
+        ["NAME MBR", "3 c"],
+    ]
+
+
+def test_chunk_lines_splits_on_character_budget(monkeypatch):
+    monkeypatch.setattr(main, "_CHUNK_CHARS", 25)
+    lines = ["NAME MRN", "1 " + "x" * 10, "2 " + "y" * 10]
+
+    assert main._chunk_lines(lines) == [
+        ["NAME MRN", "1 " + "x" * 10],
+        ["NAME MRN", "2 " + "y" * 10],
+    ]
+
+
+def fake_completions(monkeypatch, create):
+    completions = SimpleNamespace(create=create)
+    monkeypatch.setattr(main, "aclient", SimpleNamespace(chat=SimpleNamespace(
+        completions=completions
+    )))
+
+
+def test_extract_chunks_cancels_pending_chunks_on_failure(monkeypatch):
+    pending = []
+
+    async def create(**kwargs):
+        if "boom" in kwargs["messages"][-1]["content"]:
+            await asyncio.sleep(0)
+            raise RuntimeError("rate limited")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            pending.append("cancelled")
+            raise
+
+    fake_completions(monkeypatch, create)
+
+    async def run():
+        with pytest.raises(RuntimeError, match="rate limited"):
+            await main._extract_chunks([["1 a"], ["boom"], ["2 b"]])
+        # Let the cancelled tasks unwind
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+
+    assert pending == ["cancelled", "cancelled"]
+
+
+def test_extract_rejects_tables_over_chunk_limit(monkeypatch):
+    calls = []
+
+    async def read_lines(file):
+        return [f"{n} Doe, Jane" for n in range(10)]
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+
+    monkeypatch.setattr(main, "_read_pdf_lines", read_lines)
+    monkeypatch.setattr(main, "_CHUNK_LINES", 3)
+    monkeypatch.setattr(main, "_MAX_CHUNKS", 3)
+    fake_completions(monkeypatch, create)
+
+    result = asyncio.run(main.extract_merged(SimpleNamespace(filename="a.pdf")))
+
+    assert result == {
+        "status": False,
+        "data": [],
+        "error": "Table too large: 4 chunks (limit 3)",
+    }
+    assert calls == []
+
+
+def test_extract_serves_repeat_uploads_from_cache(monkeypatch):
+    calls = []
+
+    async def read_lines(file):
+        return ["NAME MRN", "1 Cached, Jane 123"]
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        content = json.dumps({"rows": [{"Name": "Cached, Jane"}]})
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))]
+        )
+
+    monkeypatch.setattr(main, "_read_pdf_lines", read_lines)
+    fake_completions(monkeypatch, create)
+    upload = SimpleNamespace(filename="a.pdf")
+
+    first = asyncio.run(main.extract_merged(upload))
+    second = asyncio.run(main.extract_merged(upload))
+
+    assert first == second
+    assert second["data"][0]["Name"] == "Cached, Jane"
+    assert len(calls) == 1
+
+
+def test_completion_body_requests_strict_row_schema():
+    body = main._completion_body(["1 Doe, Jane"])
+    schema = body["response_format"]["json_schema"]
+    row = schema["schema"]["properties"]["rows"]["items"]
+
+    assert body["response_format"]["type"] == "json_schema"
+    assert schema["strict"] is True
+    # Strict mode rejects optional fields and extra keys
+    assert row["required"] == list(main._FIELDS)
+    assert row["additionalProperties"] is False
\ No newline at end of file